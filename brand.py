@@ -1,15 +1,28 @@
 import os
-import json
+import orjson
+import re
+import asyncio
 import logging
 from tempfile import NamedTemporaryFile
 from pathlib import Path
 from shlex import split
-from subprocess import Popen, PIPE
-from itertools import chain
+from asyncio.subprocess import PIPE
+from itertools import chain, count
 
 SUCCESS = 0
 FAILURE = 1
 
+WORKERS = 4
+
+# Exposure index in the first 4 characters of a negative's name
+INDEX = re.compile(r'[_A]*(\d+)')
+
+# Keep exiftool data files in memory when a tmpfs is available
+DATA_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access(
+    '/dev/shm', os.W_OK) else None
+
+EXTENSIONS = {'.tiff', '.jpg'}
+
 TEMPLATE = """
 {
   "Make": "NIKON CORPORATION",
@@ -28,43 +41,25 @@ TEMPLATE = """
 
 class Record:
     empty = 'N/A'
-    fields = ['fnumber', 'sspeed', 'flength', 'comment', 'date', 'coordinates']
+    fields = ('fnumber', 'sspeed', 'flength', 'comment', 'date', 'coordinates')
+    __slots__ = fields
 
-    def __init__(self):
-        for field in Record.fields:
-            setattr(self, field, Record.empty)
+    def __init__(self, *values):
+        values = values + (Record.empty, ) * (len(Record.fields) - len(values))
 
-    @classmethod
-    def create_from(cls, line: str):
-        record = cls()
+        (self.fnumber, self.sspeed, self.flength, self.comment, self.date,
+         self.coordinates) = values[:len(Record.fields)]
 
-        for (k, v) in zip(Record.fields, line.split('\t')):
-            setattr(record, k, v)
+    def is_empty(self):
+        return all(
+            getattr(self, field) == Record.empty for field in Record.fields)
 
-        return record
+    @classmethod
+    def create_from(cls, line: str):
+        return cls(*line.split('\t'))
 
     def export(self):
-        coordinates = {}
-
-        if self.coordinates and self.coordinates != Record.empty:
-            try:
-                lat, lon = self.coordinates.split(',')
-                la_ref, lo_ref = 'N', 'E'
-                if lat.startswith('-'):
-                    la_ref = 'S'
-                if lon.startswith('-'):
-                    lo_ref = 'W'
-                coordinates = {
-                    "GPSLatitude": lat,
-                    "GPSLatitudeRef": la_ref,
-                    "GPSLongitude": lon,
-                    "GPSLongitudeRef": lo_ref,
-                }
-            except:
-                logging.error("Badly formatted coordinates: %s",
-                              self.coordinates)
-
-        return coordinates | {
+        exported = {
             "shutterspeed": self.sspeed,
             "ApertureValue": self.fnumber,
             "FNumber": self.fnumber,
@@ -73,68 +68,230 @@ class Record:
             "alldates": self.date,
         }
 
+        if self.coordinates and self.coordinates != Record.empty:
+            lat, sep, lon = self.coordinates.partition(',')
+
+            if not sep or ',' in lon:
+                logging.error("Badly formatted coordinates: %s",
+                              self.coordinates)
+            else:
+                la_ref = 'S' if lat.startswith('-') else 'N'
+                lo_ref = 'W' if lon.startswith('-') else 'E'
+                exported["GPSLatitude"] = lat
+                exported["GPSLatitudeRef"] = la_ref
+                exported["GPSLongitude"] = lon
+                exported["GPSLongitudeRef"] = lo_ref
+
+        return exported
+
 
 def get_index(filename):
-    index = int(Path(filename).stem[0:4].strip('_').strip('A'))
+    match = INDEX.match(os.path.basename(filename), 0, 4)
+
+    if match is None:
+        return None
+
+    index = int(match.group(1))
     logging.info("File '%s' has index '%d'", filename, index)
     return index
 
 
-def read_tse(filename: Path):
-    with open(filename, 'r', encoding='utf-8') as tse:
-        lines = list(map(lambda l: l.strip('\n'), tse.readlines()))
+def list_negatives(directory: Path):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(
+                    entry.name)[1].lower() in EXTENSIONS:
+                yield Path(entry.path)
 
-    template = {}
-    for field in filter(lambda l: l[0] == '#', lines):
-        els = field.split()
-        template[els[0].strip('#')] = ' '.join(els[1:])
 
+def read_tse(filename: Path):
+    template = {}
     records = {}
-    entries = filter(lambda l: l[0] not in ['#', ';'], lines)
-    for index, value in enumerate(entries, start=1):
-        records[index] = Record.create_from(value)
+    index = 1
+
+    with open(filename, 'r', encoding='utf-8') as tse:
+        for line in tse:
+            line = line.rstrip('\n')
+            lead = line[:1]
+
+            if lead == '#':
+                key, *value = line.split()
+                template[key.strip('#')] = ' '.join(value)
+            elif lead and lead != ';':
+                records[index] = Record.create_from(line)
+                index += 1
 
     return template, records
 
 
-def main(negatives_dir: Path, tse_file: Path):
-    filenames = list(negatives_dir.glob('*tiff')) + list(
-        negatives_dir.glob('*jpg'))
+def write_json(payload: bytes) -> str:
+    with NamedTemporaryFile('wb', prefix='brand_', dir=DATA_DIR,
+                            delete=False) as datafile:
+        datafile.write(payload)
+
+    return datafile.name
+
+
+async def log_stream(stream: asyncio.StreamReader, pid: int):
+    while line := await stream.readline():
+        message = line.decode(errors='replace').rstrip()
+
+        # With stay_open, these lines are the only sign a file was not tagged
+        if message.startswith('Error'):
+            logging.critical("exiftool[%d]: %s", pid, message)
+        else:
+            logging.warning("exiftool[%d]: %s", pid, message)
+
 
+async def execute(exiftool: asyncio.subprocess.Process, number: int, data: str,
+                  files: list[Path]) -> bool:
+    arguments = [f"-j={data}"] + list(map(str, files))
+    command = "\n".join(arguments) + f"\n-execute{number}\n"
+    ready = f"{{ready{number}}}\n".encode()
+
+    try:
+        exiftool.stdin.write(command.encode())
+        await exiftool.stdin.drain()
+
+        while (line := await exiftool.stdout.readline()) != ready:
+            if not line:
+                raise ConnectionResetError
+    except ConnectionError:
+        logging.critical("exiftool exited while tagging %s",
+                         ", ".join(map(str, files)))
+        return False
+
+    return True
+
+
+async def spawn_exiftool():
+    exiftool = await asyncio.create_subprocess_exec(
+        *split("exiftool -stay_open True -@ - -common_args -m -q"),
+        stdin=PIPE,
+        stdout=PIPE,
+        stderr=PIPE)
+    errors = asyncio.create_task(log_stream(exiftool.stderr, exiftool.pid))
+
+    return exiftool, errors
+
+
+async def reap_exiftool(exiftool: asyncio.subprocess.Process,
+                        errors: asyncio.Task):
+    await errors
+
+    if status := await exiftool.wait():
+        logging.critical("Process %d failed with status %d", exiftool.pid,
+                         status)
+
+
+async def tag_worker(jobs: asyncio.Queue):
+    exiftool = None
+
+    for number in count(1):
+        try:
+            data, files = jobs.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+
+        try:
+            if exiftool is None:
+                exiftool, errors = await spawn_exiftool()
+
+            tagged = await execute(exiftool, number, data, files)
+        except Exception:
+            logging.critical("Files were not tagged: %s",
+                             ", ".join(map(str, files)))
+
+            if exiftool is not None and exiftool.returncode is None:
+                exiftool.kill()
+
+            raise
+
+        if not tagged:
+            # Start a new process for the next job so the rest still get tagged
+            await reap_exiftool(exiftool, errors)
+            exiftool = None
+
+    if exiftool is not None:
+        try:
+            exiftool.stdin.write(b"-stay_open\nFalse\n")
+            await exiftool.stdin.drain()
+        except ConnectionError:
+            pass
+
+        await reap_exiftool(exiftool, errors)
+
+
+async def tag(todo: dict[bytes, list[Path]]):
+    written = await asyncio.gather(
+        *[asyncio.to_thread(write_json, payload) for payload in todo],
+        return_exceptions=True)
+    datafiles = [path for path in written if isinstance(path, str)]
+
+    try:
+        for result in written:
+            if isinstance(result, BaseException):
+                raise result
+
+        jobs = asyncio.Queue()
+        for job in zip(datafiles, todo.values()):
+            jobs.put_nowait(job)
+
+        workers = [
+            asyncio.create_task(tag_worker(jobs))
+            for _ in range(min(WORKERS, os.cpu_count() or 1, len(todo)))
+        ]
+
+        try:
+            results = await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            # Data files must outlive every worker that may still read them
+            for worker in workers:
+                worker.cancel()
+
+            if workers:
+                await asyncio.wait(workers)
+
+        for result in results:
+            if isinstance(result, Exception):
+                logging.critical("Tagging worker failed: %s", result)
+
+        # Jobs left over when every worker has crashed
+        while not jobs.empty():
+            _, files = jobs.get_nowait()
+            logging.critical("Files were not tagged: %s",
+                             ", ".join(map(str, files)))
+    finally:
+        for datafile in datafiles:
+            if Path(datafile).exists():
+                os.unlink(datafile)
+
+
+def main(negatives_dir: Path, tse_file: Path):
     template, records = read_tse(tse_file)
+    template_items = tuple(template.items())
 
-    todo = []
+    todo = {}
 
-    for filename in filenames:
+    # Resolve the directory once so listed paths are already absolute
+    for filename in list_negatives(negatives_dir.resolve()):
         index = get_index(filename)
 
         if index not in records:
             logging.error("Missing exposure record for file '%s'", filename)
             continue
 
-        data = template.copy()
-
-        data.update(records[index].export())
-
-        with NamedTemporaryFile('w+', delete=False) as datafile:
-            json.dump(data, datafile)
-            todo.append((filename, datafile.name))
+        if not template and records[index].is_empty():
+            logging.info("Nothing to tag in file '%s'", filename)
+            continue
 
-    logging.info("Tagging %d files" % len(todo))
-    processes = []
+        data = dict(chain(template_items, records[index].export().items()))
 
-    for filename, data in todo:
-        command = f"exiftool -m -q -j={data} {filename.resolve()}"
-        processes.append(Popen(split(command), stdout=PIPE, stderr=PIPE))
+        todo.setdefault(orjson.dumps(data), []).append(filename)
 
-    for proc in processes:
-        if status := proc.wait():
-            logging.critical("Process %d failed with status %d: %s", proc.pid,
-                             proc.returncode, proc.stderr)
+    logging.info("Tagging %d files" % sum(map(len, todo.values())))
 
-    for _, datafile in todo:
-        if Path(datafile).exists():
-            os.unlink(datafile)
+    asyncio.run(tag(todo))
 
 
 if __name__ == '__main__':
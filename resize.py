@@ -1,54 +1,64 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import asyncio
 import logging
 from shutil import which
-from shlex import split
-from PIL import Image
-from subprocess import Popen, PIPE
+from asyncio.subprocess import DEVNULL, PIPE
 from pathlib import Path
 
+MAGICK = which('magick') or which('convert')
 
-def compress_clean(imagefile: Path, processes: list[Popen]):
-    magick_tool = which('magick')
+if MAGICK is None:
+    raise RuntimeError("ImageMagick was not found in PATH")
 
-    convert_tiff = f"""{magick_tool} '{imagefile.resolve()}' -compress lzw '{imagefile.with_suffix('.tiff')}' """
 
-    logging.debug("TIFF: %s", split(convert_tiff))
+async def magick(*arguments: str) -> bool:
+    logging.debug("Running: %s", ' '.join(arguments))
 
-    processes.append(Popen(split(convert_tiff), stdout=PIPE, stderr=PIPE))
+    proc = await asyncio.create_subprocess_exec(MAGICK,
+                                                *arguments,
+                                                stdout=DEVNULL,
+                                                stderr=PIPE)
+    _, errors = await proc.communicate()
 
+    if proc.returncode:
+        logging.critical("Command '%s' failed with error code %d: %s",
+                         ' '.join(arguments), proc.returncode,
+                         errors.decode(errors='replace').strip())
 
-def create_thumb(imagefile: Path, processes: list[Popen]):
-    magick_tool = which('magick')
-    image = Image.open(imagefile)
-    width, height = image.size
+    return not proc.returncode
 
-    convert_jpg = f"""{magick_tool} '{imagefile.resolve()}' -resize "{width//2}"x"{height//2}" '{imagefile.with_suffix('.jpg')}' """
 
-    logging.debug("JPG: %s", split(convert_jpg))
+async def process(imagefile: Path, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        if imagefile.suffix == '.tif':
+            compressed = imagefile.with_suffix('.tiff')
 
-    processes.append(Popen(split(convert_jpg), stdout=PIPE, stderr=PIPE))
+            if not await magick(str(imagefile), '-compress', 'lzw',
+                                str(compressed)):
+                return
 
+            imagefile = compressed
 
-def apply_transformation(reg, transform):
-    conversions = []
+        await magick(f"{imagefile}[0]", '-resize', '50%',
+                     str(imagefile.with_suffix('.jpg')))
 
-    for file in directory.glob(reg):
-        logging.debug("Converting '%s'", file)
-        transform(file, conversions)
 
-    for proc in conversions:
-        status = proc.wait()
+async def convert(directory: Path):
+    semaphore = asyncio.Semaphore(os.cpu_count() or 1)
 
-        if status:
-            logging.critical(f"Process %d failed with error code %d: %s",
-                             proc.pid, proc.returncode, proc.stderr)
+    # Compressed TIFFs left over from a previous run only need a thumbnail
+    files = list(directory.resolve().glob('*tif')) + [
+        tiff for tiff in directory.resolve().glob('*tiff')
+        if not tiff.with_suffix('.tif').exists()
+    ]
+
+    await asyncio.gather(*[process(file, semaphore) for file in files])
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    directory = Path(sys.argv[1])
 
-    apply_transformation('*tif', compress_clean)
-    apply_transformation('*tiff', create_thumb)
+    asyncio.run(convert(Path(sys.argv[1])))